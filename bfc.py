@@ -1,41 +1,74 @@
 import argparse
 import pathlib
+import re
 
 MINIMUM_TARGET_SIZE = 30_000
-
+PAGE_SIZE = 4096
+OUTPUT_BUFFER_SIZE = 4096
+
+# the tape is rounded up to whole pages and fenced by inaccessible guard
+# pages on either side, so touching any cell off either end faults in the
+# MMU rather than needing a compare and branch on every shift. Each net
+# shift also clamps an out-of-range pointer, without branching, to a
+# sentinel deep enough inside the lower guard that no displaced access from
+# it can reach the tape, so a long shift cannot jump clean over a guard.
+#
+# The tape base and pointer are kept in %r12 and %r13 for the whole
+# program, and output is collected in a buffer based at %r15 and filled to
+# %r14; all of these are preserved across syscalls, so they never need to
+# be spilled.
 PROGRAM_HEADER = """.section .data
 has_read:
     .byte 0
-region:
-    .zero {0}
-pointer:
-    .long 0
+out_of_range:
+    .quad {5}
+segv_action:
+    .quad abort
+    .quad 0x04000000
+    .quad abort
+    .quad 0
 abort_message:
     .string "abort: pointer out of range"
     abort_message_len = (. - abort_message)
 
+.section .bss
+outbuf:
+    .zero {4}
+.balign {3}
+guard_low:
+    .zero {2}
+region:
+    .zero {0}
+guard_high:
+    .zero {2}
+
 .section .text
 .global _start
 
-dotproc:
+flushbuf:
+    testq %r14, %r14
+    jz 1f
     movq $1, %rdi
-    lea [region], %rsi
-    add [pointer], %esi
-    movq $1, %rdx
+    movq %r15, %rsi
+    movq %r14, %rdx
     movq $1, %rax
     syscall
+    xor %r14, %r14
+1:
     ret
 commaproc:
-    movq $1, [has_read]
+    call flushbuf
+    movb $1, [has_read]
+    lea (%r12,%r13), %rsi
+    testb $0, (%rsi)
     movq $0, %rdi
-    lea [region], %rsi
-    add [pointer], %esi
     movq $1, %rdx
     movq $0, %rax
     syscall
     ret
 
 cleanup:
+    call flushbuf
     cmpb $1, [has_read]
     jne exit
 clearbuf:
@@ -53,6 +86,7 @@ exit:
     syscall
 
 abort:
+    call flushbuf
     movq $1, %rdi
     lea [abort_message], %rsi
     movq $abort_message_len, %rdx
@@ -61,189 +95,392 @@ abort:
     jmp exit
 
 _start:
+    lea guard_low(%rip), %rdi
+    movq ${2}, %rsi
+    movq $0, %rdx
+    movq $10, %rax
+    syscall
+    lea guard_high(%rip), %rdi
+    movq ${2}, %rsi
+    movq $0, %rdx
+    movq $10, %rax
+    syscall
+
+    movq $11, %rdi
+    lea segv_action(%rip), %rsi
+    movq $0, %rdx
+    movq $8, %r10
+    movq $13, %rax
+    syscall
+
+    lea region(%rip), %r12
+    xor %r13, %r13
+    lea outbuf(%rip), %r15
+    xor %r14, %r14
 """
-SHIFT_RIGHT_INSTRUCTION = """addl $%d, [pointer]
-cmpl $-1, [pointer]
-je abort\n"""
-SHIFT_LEFT_INSTRUCTION = """subl $%d, [pointer]
-cmpl $-1, [pointer]
-je abort\n"""
-ADD_INSTRUCTION = """lea [region], %%eax
-add [pointer], %%eax
-addb $%d, (%%eax)\n"""
-SUB_INSTRUCTION = """lea [region], %%eax
-add [pointer], %%eax
-subb $%d, (%%eax)\n"""
+SHIFT_RIGHT_INSTRUCTION = "addq $%d, %%r13\n"
+SHIFT_LEFT_INSTRUCTION = "subq $%d, %%r13\n"
+BOUNDS_INSTRUCTION = """cmpq $%d, %%r13
+cmovae out_of_range(%%rip), %%r13\n"""
+STEP_RIGHT_INSTRUCTION = "incq %r13\n"
+STEP_LEFT_INSTRUCTION = "decq %r13\n"
+ADD_INSTRUCTION = "addb $%d, %s\n"
+SUB_INSTRUCTION = "subb $%d, %s\n"
+INCREMENT_INSTRUCTION = "incb %s\n"
+DECREMENT_INSTRUCTION = "decb %s\n"
+LOOP_START_INSTRUCTION = """%s:
+cmpb $0, (%%r12,%%r13)
+je %s\n"""
+LOOP_END_INSTRUCTION = """%s:
+cmpb $0, (%%r12,%%r13)
+jne %s\n"""
+CLEAR_INSTRUCTION = "movb $0, (%r12,%r13)\n"
+MULTIPLY_START_INSTRUCTION = """movzbl (%r12,%r13), %eax
+testl %eax, %eax
+jz 1f\n"""
+MULTIPLY_ADD_INSTRUCTION = "addb %%al, %s\n"
+MULTIPLY_SUB_INSTRUCTION = "subb %%al, %s\n"
+MULTIPLY_SCALED_INSTRUCTION = """imull $%d, %%eax, %%edx
+addb %%dl, %s\n"""
+MULTIPLY_END_INSTRUCTION = """movb $0, (%r12,%r13)
+1:\n"""
+OUTPUT_FLUSH_INSTRUCTION = """cmpq $%d, %%r14
+jbe 1f
+call flushbuf
+1:
+movb (%%r12,%%r13), %%al\n"""
+OUTPUT_INSTRUCTION = "movb %%al, %d(%%r15,%%r14)\n"
+OUTPUT_ADVANCE_INSTRUCTION = "addq $%d, %%r14\n"
+SCAN_RIGHT_INSTRUCTION = """lea (%%r12,%%r13), %%rdi
+movq $%d, %%rcx
+subq %%r13, %%rcx
+jbe abort
+xor %%eax, %%eax
+repne scasb
+jne abort
+lea -1(%%rdi), %%r13
+subq %%r12, %%r13\n"""
+SCAN_LEFT_INSTRUCTION = """lea (%r12,%r13), %rdi
+movq %r13, %rcx
+incq %rcx
+jle abort
+xor %eax, %eax
+std
+repne scasb
+cld
+jne abort
+lea 1(%rdi), %r13
+subq %r12, %r13\n"""
 VALID_TOKENS = "<>[].,+-"
+_VALID = frozenset(VALID_TOKENS)
+SHIFT_TOKENS = frozenset("<>")
+MUTATE_TOKENS = frozenset("+-")
+# tokens that are emitted together as a straight-line block
+BLOCK_TOKENS = SHIFT_TOKENS | MUTATE_TOKENS
+# every latin-1 byte that is not a token, for stripping with bytes.translate
+_INVALID_BYTES = bytes(i for i in range(256) if chr(i) not in _VALID)
+# loops with a known effect, compiled without a generic loop, each paired
+# with the BFCompiler method that emits it; these are matched before the
+# generic tokens, in this order
+IDIOMS = [
+    (re.compile(r"\[[+-]\]"), "__produce_clear_instruction"),
+    (re.compile(r"\[[<>]\]"), "__produce_scan_instruction"),
+]
+# runs of shifts, of mutations and of outputs are each fused into one token
+TOKEN_PATTERN = re.compile("|".join(
+    [pattern.pattern for pattern, _ in IDIOMS] + [r"[<>]+", r"[+-]+", r"\.+", r"[\[\],]"]
+))
 
 
 class BFCompiler:
     source: str
-    cursor: int
+    tokens: list[str]
 
     labels: dict[int, str]
+    pairs: dict[int, int]
+    # loops replaced by multiplication, keyed by the index of their '['
+    multiplies: dict[int, dict[int, int]]
 
     num_cells: int
-
-    # optimization state
-    consumed: int
-    quantity: int
+    # cells actually usable, rounded up to whole pages
+    tape_size: int
+    # furthest any cell access is displaced from the pointer
+    reach: int
 
     @staticmethod
     def normalize(source_code):
-        return "".join([c for c in source_code if c in VALID_TOKENS])
+        # non-latin-1 characters can never be tokens, so they are dropped
+        # by the encode before the remainder is filtered in one pass
+        raw = source_code.encode("latin1", "ignore")
+        return raw.translate(None, _INVALID_BYTES).decode("latin1")
+
+    @staticmethod
+    def tokenize(source_code):
+        """
+        Split normalized source into tokens, fusing each run of shifts or
+        mutations into a single token.
+        """
+        return TOKEN_PATTERN.findall(source_code)
 
     def __init__(self, source: str, size = 30_000):
         self.label_counter = 0
         self.labels = {}
+        self.multiplies = {}
 
         self.source = BFCompiler.normalize(source)
-        self.cursor = 0
+        self.tokens = BFCompiler.tokenize(self.source)
+        # validated up front, so a malformed program fails on construction
+        self.__match_brackets()
         self.num_cells = size
+        # the tape ends exactly where guard_high begins, so every cell past
+        # it faults; the rounding only ever adds cells to what was asked for
+        self.tape_size = -(-size // PAGE_SIZE) * PAGE_SIZE
+        self.reach = 1
 
     def __produce_header(self):
         buf_size = min(self.num_cells, 1024)
-        return PROGRAM_HEADER.format(self.num_cells, buf_size)
-
-    def __produce_shift_instruction(self) -> str | None:
-        char = self.source[self.cursor]
-        while char in ["<", ">"]:
-            self.consumed += 1
-            self.quantity += 1 if char == ">" else -1
-            self.cursor += 1
-            if self.cursor == len(self.source):
-                break
-
-            char = self.source[self.cursor]
-
-        if self.consumed > 0:
-            if self.quantity > 0:
-                # emit instruction
-                return SHIFT_RIGHT_INSTRUCTION % self.quantity
-            if self.quantity < 0:
-                return SHIFT_LEFT_INSTRUCTION % -self.quantity
+        # every access displaced from the sentinel must land in the lower
+        # guard, so it has to be twice as wide as the furthest displacement
+        sentinel = -(self.reach + 1)
+        guard_size = -(-(2 * self.reach + 2) // PAGE_SIZE) * PAGE_SIZE
+        return PROGRAM_HEADER.format(
+            self.tape_size, buf_size, guard_size, PAGE_SIZE, OUTPUT_BUFFER_SIZE, sentinel
+        )
+
+    def __produce_shift_instruction(self, quantity: int) -> str:
+        if quantity == 1:
+            return STEP_RIGHT_INSTRUCTION
+        elif quantity == -1:
+            return STEP_LEFT_INSTRUCTION
+        elif quantity > 0:
+            return SHIFT_RIGHT_INSTRUCTION % quantity
+        elif quantity < 0:
+            return SHIFT_LEFT_INSTRUCTION % -quantity
+        else:
+            # all continguous moves cancel out
+            return ""
+
+    def __get_cell(self, offset: int) -> str:
+        if offset == 0:
+            return "(%r12,%r13)"
+        else:
+            return "%d(%%r12,%%r13)" % offset
+
+    def __produce_mutate_instruction(self, offset: int, quantity: int) -> str:
+        cell = self.__get_cell(offset)
+
+        # cells wrap, so only the amount modulo 256 matters; pick the
+        # shortest encoding for it
+        quantity &= 0xFF
+        if quantity == 0:
+            # all contiguous add/subtracts cancel out
+            return ""
+        elif quantity == 1:
+            return INCREMENT_INSTRUCTION % cell
+        elif quantity == 0xFF:
+            return DECREMENT_INSTRUCTION % cell
+        elif quantity <= 0x80:
+            return ADD_INSTRUCTION % (quantity, cell)
+        else:
+            return SUB_INSTRUCTION % (0x100 - quantity, cell)
+
+    def __get_block_effect(self, tokens: list[str]) -> tuple[int, dict[int, int]]:
+        """
+        Work out the net pointer offset of a run of shift and mutate tokens,
+        and the net amount added to each cell relative to where it started.
+        """
+        offset = 0
+        mutations: dict[int, int] = {}
+        for token in tokens:
+            if token[0] in SHIFT_TOKENS:
+                offset += token.count(">") - token.count("<")
             else:
-                # all continguous moves cancel out
-                return ""
-
-        return None
-
-    def __produce_mutate_instruction(self) -> str | None:
-        char = self.source[self.cursor]
-        while char in ["+", "-"]:
-            self.consumed += 1
-            self.quantity += 1 if char == "+" else -1
-            self.cursor += 1
-            if self.cursor == len(self.source):
-                break
-
-            char = self.source[self.cursor]
-
-        if self.consumed > 0:
-            instruction = "lea [region], %eax\nadd [pointer], %eax\n"
-            if self.quantity > 0:
-                return ADD_INSTRUCTION % self.quantity
-            elif self.quantity < 0:
-                return SUB_INSTRUCTION % -self.quantity
+                quantity = token.count("+") - token.count("-")
+                mutations[offset] = mutations.get(offset, 0) + quantity
+
+        mutations = {cell: quantity for cell, quantity in mutations.items() if quantity & 0xFF}
+        return offset, mutations
+
+    def __produce_block(self, tokens: list[str]) -> str:
+        """
+        Emit a straight-line run of shift and mutate tokens. Shifts only
+        move a compile-time offset that mutations use as a displacement, and
+        the pointer register is updated once at the end of the block.
+        """
+        offset, mutations = self.__get_block_effect(tokens)
+        self.reach = max([self.reach, abs(offset)] + [abs(cell) for cell in mutations])
+
+        output = []
+        for cell, quantity in mutations.items():
+            output.append(self.__produce_mutate_instruction(cell, quantity))
+        output.append(self.__produce_shift_instruction(offset))
+        if offset != 0:
+            output.append(BOUNDS_INSTRUCTION % self.tape_size)
+
+        return "".join(output)
+
+    def __produce_output_instruction(self, token: str) -> str:
+        """
+        Append the current cell to the output buffer once per '.' in the
+        run, flushing beforehand only if the run would not fit. The buffer
+        is otherwise written out only before input and at exit.
+        """
+        output = []
+        remaining = len(token)
+        while remaining > 0:
+            count = min(remaining, OUTPUT_BUFFER_SIZE)
+            output.append(OUTPUT_FLUSH_INSTRUCTION % (OUTPUT_BUFFER_SIZE - count))
+            for index in range(count):
+                output.append(OUTPUT_INSTRUCTION % index)
+            output.append(OUTPUT_ADVANCE_INSTRUCTION % count)
+            remaining -= count
+
+        return "".join(output)
+
+    def __produce_clear_instruction(self, token: str) -> str:
+        return CLEAR_INSTRUCTION
+
+    def __produce_multiply_instruction(self, factors: dict[int, int]) -> str:
+        if not factors:
+            return CLEAR_INSTRUCTION
+
+        self.reach = max([self.reach] + [abs(cell) for cell in factors])
+
+        output = [MULTIPLY_START_INSTRUCTION]
+        for cell, factor in factors.items():
+            operand = self.__get_cell(cell)
+            if factor == 1:
+                output.append(MULTIPLY_ADD_INSTRUCTION % operand)
+            elif factor == 0xFF:
+                output.append(MULTIPLY_SUB_INSTRUCTION % operand)
             else:
-                # all contiguous add/subtracts cancel out
-                return ""
-
-        return None
-
-    def __produce_loop_start(self):
-        target = self.__lookahead()
-        return """%s:
-lea [region], %%eax
-add [pointer], %%eax
-cmpb $0, (%%eax)
-je %s\n""" % (self.__get_label(self.cursor), target)
-
-    def __produce_loop_end(self):
-        target = self.__lookbehind()
-        return """%s:
-lea [region], %%eax
-add [pointer], %%eax
-cmpb $0, (%%eax)
-jne %s\n""" % (self.__get_label(self.cursor), target)
-
-    def __produce_instruction(self):
-        if self.cursor == len(self.source):
-            raise StopIteration()
-
-        self.consumed = 0
-        self.quantity = 0
-
-        instruction = self.__produce_shift_instruction()
-        if instruction is not None:
-            return instruction
-
-        instruction = self.__produce_mutate_instruction()
-        if instruction is not None:
-            return instruction
-
-        char = self.source[self.cursor]
-        instruction = ""
-        if char == "[":
-            instruction = self.__produce_loop_start()
+                output.append(MULTIPLY_SCALED_INSTRUCTION % (factor, operand))
+        output.append(MULTIPLY_END_INSTRUCTION)
+
+        return "".join(output)
+
+    def __produce_scan_instruction(self, token: str) -> str:
+        if token[1] == ">":
+            return SCAN_RIGHT_INSTRUCTION % self.tape_size
+        else:
+            return SCAN_LEFT_INSTRUCTION
+
+    def __produce_loop_start(self, index: int):
+        target = self.__get_label(self.pairs[index])
+        return LOOP_START_INSTRUCTION % (self.__get_label(index), target)
+
+    def __produce_loop_end(self, index: int):
+        target = self.__get_label(self.pairs[index])
+        return LOOP_END_INSTRUCTION % (self.__get_label(index), target)
+
+    def __produce_instruction(self, index: int, token: str) -> str:
+        char = token[0]
+        if char == "[" and len(token) > 1:
+            # the tokenizer only fuses a loop into one token by matching an
+            # idiom, so one of them always matches here
+            emitter = next(name for pattern, name in IDIOMS if pattern.fullmatch(token))
+            return getattr(self, "_BFCompiler" + emitter)(token)
+        elif char == "[":
+            return self.__produce_loop_start(index)
         elif char == "]":
-            instruction = self.__produce_loop_end()
+            return self.__produce_loop_end(index)
         elif char == ".":
-            instruction = "call dotproc\n"
+            return self.__produce_output_instruction(token)
         elif char == ",":
-            instruction = "call commaproc\n"
+            return "call commaproc\n"
         else:
-            instruction = ""
-
-        self.cursor += 1
-        return instruction
+            return ""
 
     def __get_label(self, index):
         return f"tag_{index}"
 
-    def __lookahead(self):
-        local_cursor = self.cursor + 1
-        nest_level = 0
-        while nest_level >= 0 and local_cursor < len(self.source):
-            if self.source[local_cursor] == "[":
-                nest_level += 1
-            elif self.source[local_cursor] == "]":
-                nest_level -= 1
-
-            local_cursor += 1
-
-        if nest_level < 0:
-            return self.__get_label(local_cursor - 1)
-        else:
-            raise ValueError("missing matching bracket")
-
-    def __lookbehind(self):
-        local_cursor = self.cursor - 1
-        nest_level = 0
-        while nest_level >= 0 and local_cursor > 0:
-            if self.source[local_cursor] == "]":
-                nest_level += 1
-            elif self.source[local_cursor] == "[":
-                nest_level -= 1
-
-            local_cursor -= 1
-
-        if nest_level < 0:
-            return self.__get_label(local_cursor + 1)
-        else:
-            raise ValueError("missing matching bracket")
+    def __match_brackets(self):
+        """
+        Pair every bracket with its match in a single pass, so that loop
+        targets need not be searched for each time a [ or ] is emitted. A
+        mismatch is reported by its index in the normalized source.
+        """
+        self.pairs = {}
+        stack = []
+        position = 0
+        for index, token in enumerate(self.tokens):
+            if token == "[":
+                stack.append((index, position))
+            elif token == "]":
+                if not stack:
+                    raise ValueError("missing matching bracket at index %d" % position)
+                start, _ = stack.pop()
+                self.pairs[start] = index
+                self.pairs[index] = start
+            position += len(token)
+
+        if stack:
+            _, start_position = stack[0]
+            raise ValueError("missing matching bracket at index %d" % start_position)
+
+    def __find_multiplies(self):
+        """
+        Find loops whose body only shifts and mutates, leaves the pointer
+        where it started and steps the loop cell by exactly one. Such a loop
+        runs once per unit of the loop cell's value (counting down to zero,
+        or up through 256), so it can be replaced by adding a multiple of
+        that value to every other cell it touches.
+        """
+        self.multiplies = {}
+        for start, end in self.pairs.items():
+            if start > end:
+                continue
+
+            # walk forward only until the first token that is not a shift or
+            # mutation, so an enclosing loop stops at its first nested '['
+            # and every token is visited by at most one candidate
+            body_end = start + 1
+            while body_end < end and self.tokens[body_end][0] in BLOCK_TOKENS:
+                body_end += 1
+            if body_end != end:
+                continue
+
+            offset, mutations = self.__get_block_effect(self.tokens[start + 1:end])
+            step = mutations.get(0, 0) & 0xFF
+            if offset != 0 or step not in (1, 0xFF):
+                continue
+
+            sign = 1 if step == 0xFF else -1
+            factors = {cell: (sign * quantity) & 0xFF for cell, quantity in mutations.items() if cell != 0}
+            self.multiplies[start] = {cell: factor for cell, factor in factors.items() if factor}
 
     def compile(self):
-        output = self.__produce_header()
-        while True:
-            try:
-                output += self.__produce_instruction()
-            except StopIteration:
-                break
+        self.__find_multiplies()
+
+        output = []
+        block = []
+        index = 0
+        while index < len(self.tokens):
+            token = self.tokens[index]
+            if token[0] in BLOCK_TOKENS:
+                block.append(token)
+                index += 1
+                continue
+
+            if block:
+                output.append(self.__produce_block(block))
+                block = []
+
+            if index in self.multiplies:
+                output.append(self.__produce_multiply_instruction(self.multiplies[index]))
+                index = self.pairs[index] + 1
+            else:
+                output.append(self.__produce_instruction(index, token))
+                index += 1
+
+        if block:
+            output.append(self.__produce_block(block))
 
         # add exit logic
-        output += "call cleanup"
-        return output
+        output.append("call cleanup")
+        # the header is produced last, as the guard size depends on how far
+        # the blocks displace their cell accesses
+        return self.__produce_header() + "".join(output)
 
 
 # these steps are handled by external tools (as and ld)
@@ -296,7 +533,11 @@ def main():
         sys.exit(1)
     
     source_code = options.source.read()
-    compiler = BFCompiler(source_code, options.target_size)
+    try:
+        compiler = BFCompiler(source_code, options.target_size)
+    except ValueError as err:
+        sys.stderr.write("fatal: %s\n" % str(err))
+        sys.exit(1)
     assembly = compiler.compile()
 
     if options.assemble_only:
@@ -1,10 +1,34 @@
 import argparse
+import array
+import collections
 import pathlib
+import re
 import sys
 
+try:
+    import numba
+    import numpy
+except ImportError:
+    numba = None
+
 
 VALID_TOKENS = "<>[].,+-"
+_VALID = frozenset(VALID_TOKENS)
+SHIFT_TOKENS = frozenset("<>")
+MUTATE_TOKENS = frozenset("+-")
+# every latin-1 byte that is not a token, for stripping with bytes.translate
+_INVALID_BYTES = bytes(i for i in range(256) if chr(i) not in _VALID)
 MINIMUM_TARGET_SIZE = 30_000
+# runs of shifts and of mutations are each fused into one op
+RUN_PATTERN = re.compile(r"[<>]+|[+-]+|[\[\].,]")
+
+# opcodes of the compiled program, each carrying one integer argument
+OP_SHIFT = 0
+OP_ADD = 1
+OP_JZ = 2
+OP_JNZ = 3
+OP_OUT = 4
+OP_IN = 5
 
 
 class InterpreterError(Exception):
@@ -12,67 +36,74 @@ class InterpreterError(Exception):
         super().__init__(message)
 
 
-_iobuf = []
+# input read ahead of the program, stored as byte values
+_iobuf = collections.deque()
 
 
-def io_rebuffer(unused: str):
-    global _iobuf
-    _iobuf.extend(list(unused))
+def io_rebuffer(unused: bytes):
+    _iobuf.extend(unused)
 
 
 def io_getchar():
-    global _iobuf
     if _iobuf:
-        char = _iobuf[0]
-        _iobuf.pop(0)
+        char = _iobuf.popleft()
     else:
-        raw = sys.stdin.read(1).encode()
-        if len(raw) > 1:
-            raise InterpreterError("interpreter does not accept multibyte characters")
-        elif len(raw) == 0:
+        # make any pending output visible before blocking on input
+        sys.stdout.buffer.flush()
+        raw = sys.stdin.buffer.read(1)
+        if len(raw) == 0:
             raise InterpreterError("reached eof when scanning for input")
-        char = ord(raw)
+        char = raw[0]
 
     return char
 
 
-def tag_lookahead(source, index):
+def pair_brackets(buf, tags, stack):
     """
-    Given the index of an opening bracket, find its matched closing bracket.
+    Fill tags with the index of each bracket's match in one pass over the
+    source bytes, using stack as scratch space. Returns the index of the
+    first mismatched bracket, or -1 if they all match. Like run_ops, this
+    only touches integers and arrays so that numba can compile it.
     """
-    cursor = index + 1
-    nest_level = 1
-    while cursor < len(source):
-        char = source[cursor]
-        if char == "[":
-            nest_level += 1
-        if char == "]":
-            nest_level -= 1
-            if nest_level == 0:
-                return cursor
+    depth = 0
+    for index in range(len(buf)):
+        if buf[index] == 91:  # [
+            stack[depth] = index
+            depth += 1
+        elif buf[index] == 93:  # ]
+            if depth == 0:
+                return index
+            depth -= 1
+            tags[index] = stack[depth]
+            tags[stack[depth]] = index
+
+    if depth > 0:
+        return stack[0]
+    return -1
 
-        cursor += 1
 
-    raise InterpreterError("mismatched bracket at index %d" % index)
+if numba is not None:
+    pair_brackets = numba.njit(cache=True)(pair_brackets)
 
 
 def construct_tags(source):
     """
-    Creates a map of tags, used to evaluate loop behavior instead of
-    performing ad-hoc searches every time a [ or ] is encountered.
+    Creates a table of tags, used to evaluate loop behavior instead of
+    performing ad-hoc searches every time a [ or ] is encountered. The entry
+    for each bracket holds the index of its match; all others hold -1.
     """
-    tags = {}
-    for index in range(len(source)):
-        char = source[index]
-        if char == '[':
-            next_index = tag_lookahead(source, index)
-            tags[index] = next_index
-            tags[next_index] = index
-        elif char == ']':
-            # should already be populated, but if not, this
-            # indicates a bracket mismatch
-            if index not in tags:
-                raise InterpreterError("mismatched bracket at index %d" % index)
+    buf = source.encode("latin1")
+    if numba is not None:
+        buf = numpy.frombuffer(buf, dtype=numpy.uint8)
+        tags = numpy.full(len(buf), -1, dtype=numpy.int32)
+        stack = numpy.empty(len(buf), dtype=numpy.int32)
+    else:
+        tags = array.array("i", [-1]) * len(buf)
+        stack = array.array("i", [0]) * len(buf)
+
+    mismatch = pair_brackets(buf, tags, stack)
+    if mismatch >= 0:
+        raise InterpreterError("mismatched bracket at index %d" % mismatch)
 
     return tags
 
@@ -81,66 +112,144 @@ def clean_source(source):
     """
     Strip out irrelevant characters to optimize performance.
     """
-    return "".join([c for c in source if c in VALID_TOKENS])
+    raw = source.encode("latin1", "ignore")
+    return raw.translate(None, _INVALID_BYTES).decode("latin1")
+
+
+def compile_ops(source):
+    """
+    Compile cleaned source into parallel arrays of opcodes and arguments.
+    Each run of shifts or mutations becomes a single op carrying its net
+    amount, and jumps carry the index of their matching op, so loops need
+    no lookup.
+    """
+    loop_tags = construct_tags(source)
+
+    codes = bytearray()
+    args = array.array("i")
+    loop_starts = {}
+    for match in RUN_PATTERN.finditer(source):
+        run = match.group()
+        char = run[0]
+        if char in SHIFT_TOKENS:
+            amount = run.count(">") - run.count("<")
+            if amount != 0:
+                codes.append(OP_SHIFT)
+                args.append(amount)
+        elif char in MUTATE_TOKENS:
+            amount = run.count("+") - run.count("-")
+            if amount != 0:
+                codes.append(OP_ADD)
+                args.append(amount)
+        elif char == "[":
+            loop_starts[match.start()] = len(codes)
+            codes.append(OP_JZ)
+            args.append(-1)
+        elif char == "]":
+            start = loop_starts[loop_tags[match.start()]]
+            args[start] = len(codes)
+            codes.append(OP_JNZ)
+            args.append(start)
+        elif char == ".":
+            codes.append(OP_OUT)
+            args.append(0)
+        elif char == ",":
+            codes.append(OP_IN)
+            args.append(0)
+
+    return codes, args
+
+
+def run_ops(codes, args, machine, cursor, pointer):
+    """
+    Run the compiled program from the given position until it reaches I/O,
+    moves the pointer off the tape or finishes, and return the position it
+    stopped at. I/O is left to the caller so that this loop touches nothing
+    but integers and arrays, which lets numba compile it when available.
+    """
+    cells = len(machine)
+    length = len(codes)
+    while cursor < length:
+        op = codes[cursor]
+        arg = args[cursor]
+        # ordered by how often each op runs in typical programs: mutations
+        # and shifts dominate loop bodies, and every iteration ends in a
+        # jnz while a jz only runs once per loop entry
+        if op == OP_ADD:
+            machine[pointer] = (machine[pointer] + arg) & 0xFF
+        elif op == OP_SHIFT:
+            pointer += arg
+            if pointer >= cells or pointer < 0:
+                break
+        elif op == OP_JNZ:
+            if machine[pointer] != 0:
+                cursor = arg
+        elif op == OP_JZ:
+            if machine[pointer] == 0:
+                cursor = arg
+        else:
+            break
+        cursor += 1
+
+    return cursor, pointer
+
+
+if numba is not None:
+    run_ops = numba.njit(cache=True)(run_ops)
 
 
 def interpret(source, cells: int = MINIMUM_TARGET_SIZE):
     """
     Interpret the program.
     """
-    source = clean_source(source)
-    loop_tags = construct_tags(source)
+    codes, args = compile_ops(clean_source(source))
 
     machine = bytearray(cells)
-    pointer = 0
+    if numba is not None:
+        # numba needs typed arrays, which can share the compiled buffers
+        codes = numpy.frombuffer(codes, dtype=numpy.uint8)
+        args = numpy.frombuffer(args, dtype=numpy.int32)
+        tape = numpy.frombuffer(machine, dtype=numpy.uint8)
+    else:
+        tape = machine
+
+    stdout_write = sys.stdout.buffer.write
 
+    pointer = 0
     cursor = 0
-    while cursor < len(source):
-        char = source[cursor]
-        match char:
-            case ">":
-                pointer += 1
-                if pointer == cells:
-                    raise InterpreterError("pointer out of range (%d)" % cells)
-            case "<":
-                pointer -= 1
-                if pointer < 0:
-                    raise InterpreterError("pointer out of range (-1)")
-            case "+":
-                machine[pointer] = (machine[pointer] + 1) & 0xFF
-            case "-":
-                machine[pointer] = (machine[pointer] - 1) & 0xFF
-            case "[":
-                if machine[pointer] == 0:
-                    cursor = loop_tags[cursor]
-            case "]":
-                if machine[pointer] != 0:
-                    cursor = loop_tags[cursor]
-            case ".":
-                sys.stdout.write(chr(machine[pointer]))
-            case ",":
-                machine[pointer] = io_getchar()
-            case _:
-                pass
+    while True:
+        cursor, pointer = run_ops(codes, args, tape, cursor, pointer)
+        if cursor == len(codes):
+            break
+
+        if pointer >= cells or pointer < 0:
+            raise InterpreterError("pointer out of range (%d)" % pointer)
+        elif codes[cursor] == OP_OUT:
+            stdout_write(machine[pointer:pointer + 1])
+        elif codes[cursor] == OP_IN:
+            machine[pointer] = io_getchar()
         cursor += 1
 
 
 # entry point
 def read_until_char(char):
-    result = ""
+    chunks = []
+    terminator = char.encode("latin1")
 
     chunk_size = 1024
-    chunk = sys.stdin.read(chunk_size)
-    while char not in result:
-        result += chunk
-        chunk = sys.stdin.read(chunk_size)
-    result += chunk
+    while True:
+        chunk = sys.stdin.buffer.read1(chunk_size)
+        if not chunk:
+            raise InterpreterError("reached eof when scanning for %r" % char)
 
-    first_occurrence = result.index(char)
-    io_rebuffer(result[first_occurrence:])
-    result = result[:first_occurrence]
+        # only the new chunk can hold the first occurrence
+        first_occurrence = chunk.find(terminator)
+        if first_occurrence >= 0:
+            chunks.append(chunk[:first_occurrence])
+            io_rebuffer(chunk[first_occurrence:])
+            return b"".join(chunks).decode("latin1")
 
-    return result
+        chunks.append(chunk)
 
 
 def read_options():
@@ -153,13 +262,13 @@ def read_options():
 def main():
     options = read_options()
 
-    if options.source is None:
-        source = read_until_char('!')
-    else:
-        with open(options.source, "r") as fp:
-            source = fp.read()
-
     try:
+        if options.source is None:
+            source = read_until_char('!')
+        else:
+            with open(options.source, "r") as fp:
+                source = fp.read()
+
         interpret(source)
     except InterpreterError as err:
         sys.stderr.write("fatal: %s\n" % str(err))